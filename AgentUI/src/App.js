@@ -28,7 +28,8 @@ const ChatbotTemplate = () => {
                 { id: 1, type: 'bot', content: "Hello! I am the Google Cloud Storage Agent. You are looking for which project's storage buckets?", timestamp: new Date().toISOString() }
             ],
             endpoint: 'https://mcp-server-backend-652176787350.us-central1.run.app/api/prompt',
-            conversationId: null
+            conversationId: null,
+            streaming: true // Replies arrive as server-sent events
         },
         {
             id: 'gcloud-command-executor',
@@ -137,6 +138,42 @@ const ChatbotTemplate = () => {
         });
     };
 
+    // Reads the server-sent events of a streaming agent, growing the bot message as deltas arrive.
+    const readPromptStream = async (response, agentId, historyWithUserMessage) => {
+        const botMessageId = Date.now() + 1;
+        const showBotMessage = (content) => setAgents(prevAgents => prevAgents.map(agent =>
+            agent.id === agentId ? {
+                ...agent,
+                messages: [...historyWithUserMessage, { id: botMessageId, type: 'bot', content, timestamp: new Date().toISOString() }]
+            } : agent
+        ));
+
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        let content = '';
+        while (true) {
+            const { done, value } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            const events = buffer.split('\n\n');
+            buffer = events.pop();
+            for (const event of events) {
+                if (!event.startsWith('data: ')) continue;
+                const payload = JSON.parse(event.slice('data: '.length));
+                if (payload.error) {
+                    throw new Error(payload.error);
+                }
+                if (payload.delta) {
+                    content += payload.delta;
+                    showBotMessage(content);
+                } else if (payload.response !== undefined) {
+                    showBotMessage(payload.response);
+                }
+            }
+        }
+    };
+
     const handleSendMessage = async () => {
         if (!activeAgent || currentMessage.trim() === '' || !user || !gcpAccessToken) {
             if (!gcpAccessToken) alert("GCP Access Token is missing. Please sign in again.");
@@ -174,7 +211,8 @@ const ChatbotTemplate = () => {
                 // The original agents use the old format
                 requestBody = {
                     prompt: messageToSend,
-                    history: activeAgent.messages
+                    history: activeAgent.messages,
+                    stream: Boolean(activeAgent.streaming)
                 };
             }
 
@@ -187,6 +225,12 @@ const ChatbotTemplate = () => {
                 body: JSON.stringify(requestBody),
             });
 
+            const contentType = response.headers.get('Content-Type') || '';
+            if (response.ok && contentType.startsWith('text/event-stream')) {
+                await readPromptStream(response, currentAgentId, currentHistoryWithUserMessage);
+                return;
+            }
+
             const data = await response.json();
 
             if (!response.ok) {
@@ -214,9 +258,9 @@ const ChatbotTemplate = () => {
                     return agent;
                 }));
 
-            } else if (data.history) { // Fallback for the original agents
+            } else if (data.new_turns) { // Fallback for the original agents, which return only the turns added by this request
                 setAgents(prevAgents => prevAgents.map(agent =>
-                    agent.id === currentAgentId ? { ...agent, messages: data.history } : agent
+                    agent.id === currentAgentId ? { ...agent, messages: [...activeAgent.messages, ...data.new_turns] } : agent
                 ));
             } else {
                  throw new Error("The agent returned an unknown response format.");
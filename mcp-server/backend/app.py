@@ -1,9 +1,14 @@
 import os
+import orjson
+import hashlib
+import threading
+import uuid
 import vertexai
 from vertexai.generative_models import GenerativeModel, Part, Tool, FunctionDeclaration, Content
-from flask import Flask, jsonify, request
+from flask import Flask, Response, request, stream_with_context
 from flask_cors import CORS
 from datetime import datetime
+from cachetools import TTLCache
 
 from google.cloud import storage
 import google.auth
@@ -11,7 +16,14 @@ from google.oauth2 import credentials as google_credentials
 
 app = Flask(__name__)
 
-CORS(app, resources={r"/api/*": {"origins": "*"}}, headers=['Content-Type', 'Authorization'], supports_credentials=True)
+# Browsers may cache the preflight for a day, so repeat calls skip the extra round-trip.
+CORS(app, resources={r"/api/*": {"origins": "*", "max_age": 86400}}, headers=['Content-Type', 'Authorization'], supports_credentials=True)
+
+@app.before_request
+def short_circuit_preflight():
+    """Answers CORS preflights to /api/ before any view code runs; flask_cors adds the headers."""
+    if request.method == 'OPTIONS' and request.path.startswith('/api/'):
+        return '', 204
 
 # Initialize Vertex AI
 try:
@@ -21,13 +33,87 @@ try:
 except Exception as e:
     print(f"Error initializing Vertex AI: {e}")
 
+MODEL_NAME = "gemini-2.5-flash"
+FRONTEND_TO_MODEL_ROLE = {"bot": "model"}.get
+
+# Exact-match cache of prompt responses, keyed per user. Replies that ran a tool
+# are not cached, since they carry data fetched with the user's credentials.
+RESPONSE_CACHE = TTLCache(
+    maxsize=int(os.environ.get("PROMPT_CACHE_SIZE", 1024)),
+    ttl=int(os.environ.get("PROMPT_CACHE_TTL", 3600)),
+)
+RESPONSE_CACHE_LOCK = threading.Lock()
+
+def token_key(access_token):
+    """Returns a stable, non-reversible key for an access token."""
+    return hashlib.sha256(access_token.encode()).hexdigest()
+
+# Caps each user's in-flight Gemini calls so one client's burst cannot exhaust the
+# per-minute Vertex AI quota, or the worker's threads, for everyone else. Calls over
+# the cap are rejected rather than queued. The counts live in process memory, so
+# the cap applies per gunicorn worker and per Cloud Run instance.
+USER_CONCURRENCY = int(os.environ.get("USER_CONCURRENCY", 4))
+USER_IN_FLIGHT = {}
+USER_IN_FLIGHT_LOCK = threading.Lock()
+
+def acquire_user_slot(user_key):
+    """Claims a model-call slot for a user; returns False if all are in use."""
+    with USER_IN_FLIGHT_LOCK:
+        in_flight = USER_IN_FLIGHT.get(user_key, 0)
+        if in_flight >= USER_CONCURRENCY:
+            return False
+        USER_IN_FLIGHT[user_key] = in_flight + 1
+    return True
+
+def release_user_slot(user_key):
+    """Returns a slot claimed with acquire_user_slot."""
+    with USER_IN_FLIGHT_LOCK:
+        in_flight = USER_IN_FLIGHT[user_key] - 1
+        if in_flight:
+            USER_IN_FLIGHT[user_key] = in_flight
+        else:
+            del USER_IN_FLIGHT[user_key]
+
+def response_cache_key(user_key, history, prompt):
+    """Builds the cache key for a prompt and the history it was sent with.
+
+    Only the type and content of each history entry count; the frontend's ids
+    and timestamps differ on every send and would make the key unique.
+    """
+    turns = [[h.get('type'), h['content']] for h in history if h.get('content')]
+    payload = orjson.dumps(
+        {"model": MODEL_NAME, "user": user_key, "history": turns, "prompt": prompt},
+        option=orjson.OPT_SORT_KEYS,
+    )
+    return hashlib.sha256(payload).hexdigest()
+
+# storage.Client instances keyed by (project_id, token hash), so repeated tool
+# calls from the same user reuse an already-warmed HTTP session.
+STORAGE_CLIENTS = TTLCache(maxsize=256, ttl=1800)
+STORAGE_CLIENTS_LOCK = threading.Lock()
+
+def get_storage_client(project_id, credentials):
+    """Returns a cached storage.Client for the given project and credentials."""
+    key = (project_id, token_key(credentials.token))
+    with STORAGE_CLIENTS_LOCK:
+        client = STORAGE_CLIENTS.get(key)
+        if client is None:
+            client = storage.Client(credentials=credentials, project=project_id)
+            STORAGE_CLIENTS[key] = client
+    return client
+
+# Only bucket names are returned to the model, so fetch the largest pages the
+# API allows and ask for nothing but the names and the next page token.
+LIST_BUCKETS_PAGE_SIZE = 1000
+LIST_BUCKETS_FIELDS = "items(name),nextPageToken"
+
 def list_gcs_buckets_func(project_id, credentials):
     """Lists GCS buckets in a given project using provided credentials."""
     try:
         if not project_id:
             return {"error": "Project ID not provided by the model."}
-        storage_client = storage.Client(credentials=credentials, project=project_id)
-        buckets = storage_client.list_buckets()
+        storage_client = get_storage_client(project_id, credentials)
+        buckets = storage_client.list_buckets(page_size=LIST_BUCKETS_PAGE_SIZE, fields=LIST_BUCKETS_FIELDS)
         return {"buckets": [bucket.name for bucket in buckets]}
     except Exception as e:
         return {"error": str(e)}
@@ -46,70 +132,220 @@ list_buckets_tool = Tool(function_declarations=[FunctionDeclaration(
     }
 )])
 
+def build_model():
+    """Creates the Gemini model with the agent's tools attached."""
+    return GenerativeModel(MODEL_NAME, tools=[list_buckets_tool])
+
+# Built once and shared across requests; start_chat holds the per-request state.
+# Like vertexai.init above, a failure here is logged so the app still boots and
+# each request retries the construction and reports its own error.
+try:
+    MODEL = build_model()
+except Exception as e:
+    MODEL = None
+    print(f"Error creating Gemini model: {e}")
+
+# Resolve credentials and the model endpoint at boot rather than on the first
+# user request.
+if MODEL is not None:
+    try:
+        MODEL.count_tokens("warmup")
+    except Exception as e:
+        print(f"Vertex AI warmup failed: {e}")
+
+# Maps each declared function name to its implementation and the argument names
+# it reads from the model's function call.
+TOOL_DISPATCH = {
+    "list_gcs_buckets": (list_gcs_buckets_func, ("project_id",)),
+}
+
+def function_response_for(function_call, credentials):
+    """Runs the tool requested by the model and wraps its output for send_message."""
+    name = function_call.name
+    tool = TOOL_DISPATCH.get(name)
+    if tool is None:
+        return None
+    tool_fn, params = tool
+    args = function_call.args
+    tool_output = tool_fn(**{p: args.get(p) for p in params}, credentials=credentials)
+    return Part.from_function_response(name=name, response={"content": tool_output})
+
+def stamp_turns(turns):
+    """Gives turns ids unique to this response and the current timestamp.
+
+    Positions in the server-side chat history skip tool-call turns and dropped
+    empty entries, so they cannot serve as ids once the frontend appends turns.
+    """
+    prefix = uuid.uuid4().hex
+    timestamp = datetime.now().isoformat()
+    return [
+        {**turn, "id": f"msg-{prefix}-{n}", "timestamp": timestamp}
+        for n, turn in enumerate(turns)
+    ]
+
+def new_turns_for_frontend(chat, prev_len):
+    """Converts the turns added to the chat after prev_len into frontend format."""
+    new_turns = []
+    for content in chat.history[prev_len:]:
+        content_dict = content.to_dict()
+        role = content_dict.get('role')
+        if role in ["user", "model"] and content_dict.get('parts'):
+            first_part = content_dict['parts'][0]
+            if 'text' in first_part:
+                new_turns.append({
+                    "type": "bot" if role == "model" else "user",
+                    "content": first_part['text'],
+                })
+    return stamp_turns(new_turns)
+
+def json_response(payload, status=200):
+    """Serializes a payload with orjson into a JSON response."""
+    return Response(orjson.dumps(payload), status=status, mimetype="application/json")
+
+def sse_event(payload):
+    """Formats a payload as a server-sent event."""
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
+
+def stream_model_turn(chat, message, text_parts):
+    """Streams one model turn as delta events, collecting its text into text_parts.
+
+    Returns the function call the model asked for, if any.
+    """
+    function_call = None
+    for chunk in chat.send_message(message, stream=True):
+        if chunk.candidates and chunk.candidates[0].function_calls:
+            function_call = function_call or chunk.candidates[0].function_calls[0]
+            continue
+        try:
+            text = chunk.text
+        except ValueError:
+            continue
+        if text:
+            text_parts.append(text)
+            yield sse_event({'delta': text})
+    return function_call
+
+def stream_prompt(chat, prompt, prev_len, credentials, cache_key, user_key):
+    """Streams the reply to a prompt, ending with the same payload as the JSON response.
+
+    The caller claims the user's slot; it is released when the stream ends.
+    """
+    try:
+        text_parts = []
+        function_call = yield from stream_model_turn(chat, prompt, text_parts)
+        function_response = function_call and function_response_for(function_call, credentials)
+        if function_response:
+            yield from stream_model_turn(chat, function_response, text_parts)
+
+        result = {'response': ''.join(text_parts), 'new_turns': new_turns_for_frontend(chat, prev_len)}
+        if not function_response:
+            with RESPONSE_CACHE_LOCK:
+                RESPONSE_CACHE[cache_key] = result
+        yield sse_event(result)
+    finally:
+        release_user_slot(user_key)
+
+def resume_stream(first_event, events):
+    """Yields a stream whose first event was already produced.
+
+    The HTTP status is sent by then, so later failures become an error event.
+    """
+    try:
+        yield first_event
+        yield from events
+    except Exception as e:
+        print(f"CRITICAL: Streaming error: {e}")
+        yield sse_event({'error': str(e)})
+    finally:
+        events.close()
+
 @app.route('/api/prompt', methods=['POST', 'OPTIONS'])
 def handle_prompt():
-    if request.method == 'OPTIONS':
-        return '', 204
+    """Answers a prompt as JSON, or as server-sent events when the body sets "stream".
 
+    A stream is a series of {"delta": text} events followed by one event carrying
+    the full {"response", "new_turns"} payload.
+    """
     auth_header = request.headers.get('Authorization')
     if not auth_header or not auth_header.startswith('Bearer '):
-        return jsonify({'error': 'Authorization (Access Token) not provided or invalid'}), 401
+        return json_response({'error': 'Authorization (Access Token) not provided or invalid'}, 401)
 
-    access_token = auth_header.split(' ')[1]
+    access_token = auth_header[len('Bearer '):]
 
     try:
         user_credentials = google_credentials.Credentials(access_token)
 
-        data = request.get_json()
+        try:
+            data = orjson.loads(request.get_data(cache=False))
+        except orjson.JSONDecodeError:
+            return json_response({'error': 'Request body is not valid JSON'}, 400)
+        if not isinstance(data, dict):
+            return json_response({'error': 'Request body must be a JSON object'}, 400)
         prompt = data.get('prompt')
         if not prompt:
-            return jsonify({'error': 'Prompt not provided'}), 400
+            return json_response({'error': 'Prompt not provided'}, 400)
+        stream = bool(data.get('stream'))
 
-        model = GenerativeModel("gemini-2.5-flash", tools=[list_buckets_tool])
+        history_from_frontend = data.get('history', [])
+        user_key = token_key(access_token)
+        cache_key = response_cache_key(user_key, history_from_frontend, prompt)
+        with RESPONSE_CACHE_LOCK:
+            cached = RESPONSE_CACHE.get(cache_key)
+        if cached is not None:
+            cached = {**cached, 'new_turns': stamp_turns(cached['new_turns'])}
+            if stream:
+                events = [sse_event({'delta': cached['response']}), sse_event(cached)]
+                return Response(events, mimetype="text/event-stream")
+            return json_response(cached)
 
         # Convert frontend history to Vertex AI Content objects
-        history_from_frontend = data.get('history', [])
-        history_for_model = []
-        for h in history_from_frontend:
-            role = 'model' if h.get('type') == 'bot' else 'user'
-            content = h.get('content', '')
-            history_for_model.append(Content(role=role, parts=[Part.from_text(content)]))
+        history_for_model = [
+            Content(role=FRONTEND_TO_MODEL_ROLE(h.get('type'), 'user'), parts=[Part.from_text(h['content'])])
+            for h in history_from_frontend if h.get('content')
+        ]
+        prev_len = len(history_for_model)
 
+        model = MODEL or build_model()
         chat = model.start_chat(history=history_for_model)
-        response = chat.send_message(prompt)
-
-        if response.candidates and response.candidates[0].function_calls:
-            function_call = response.candidates[0].function_calls[0]
-            if function_call.name == "list_gcs_buckets":
-                args = function_call.args
-                tool_output = list_gcs_buckets_func(
-                    project_id=args.get("project_id"),
-                    credentials=user_credentials
-                )
-                response = chat.send_message(Part.from_function_response(name="list_gcs_buckets", response={"content": tool_output}))
-
-        # Convert Vertex AI history back to frontend format
-        final_history_for_frontend = []
-        for i, content in enumerate(chat.history):
-            content_dict = content.to_dict()
-            role = content_dict.get('role')
-            if role in ["user", "model"] and content_dict.get('parts'):
-                first_part = content_dict['parts'][0]
-                if 'text' in first_part:
-                    final_history_for_frontend.append({
-                        "id": f"history-msg-{i}",
-                        "type": "bot" if role == "model" else "user",
-                        "content": first_part['text'],
-                        "timestamp": datetime.now().isoformat()
-                    })
-
-        return jsonify({'response': response.text, 'history': final_history_for_frontend})
+
+        if not acquire_user_slot(user_key):
+            return json_response({'error': 'Too many concurrent requests for this user'}, 429)
+
+        if stream:
+            events = stream_prompt(chat, prompt, prev_len, user_credentials, cache_key, user_key)
+            # Run up to the first event here, so failures before any output (such as
+            # an invalid token) still get their HTTP status from the handler below.
+            first_event = next(events)
+            return Response(
+                stream_with_context(resume_stream(first_event, events)),
+                mimetype="text/event-stream",
+                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+            )
+
+        function_response = None
+        try:
+            response = chat.send_message(prompt)
+
+            if response.candidates and response.candidates[0].function_calls:
+                function_response = function_response_for(response.candidates[0].function_calls[0], user_credentials)
+                if function_response:
+                    response = chat.send_message(function_response)
+        finally:
+            release_user_slot(user_key)
+
+        # Only the turns added by this request go back; the frontend already
+        # holds everything before them.
+        result = {'response': response.text, 'new_turns': new_turns_for_frontend(chat, prev_len)}
+        if not function_response:
+            with RESPONSE_CACHE_LOCK:
+                RESPONSE_CACHE[cache_key] = result
+        return json_response(result)
 
     except Exception as e:
         print(f"CRITICAL: Main application error: {e}")
         if 'Invalid credential' in str(e):
-             return jsonify({'error': f'Invalid or expired access token: {e}'}), 401
-        return jsonify({'error': str(e)}), 500
+             return json_response({'error': f'Invalid or expired access token: {e}'}, 401)
+        return json_response({'error': str(e)}, 500)
 
 if __name__ == '__main__':
     port = int(os.environ.get("PORT", 8080))
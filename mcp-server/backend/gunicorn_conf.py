@@ -0,0 +1,16 @@
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8080)}"
+
+# Requests spend nearly all of their time waiting on Vertex AI or Cloud Storage,
+# so threads carry the concurrency. Keep a single worker by default: the response
+# cache, storage-client cache and per-user limits in app.py live in process
+# memory, and every extra worker would split them and repeat the boot warmup.
+worker_class = "gthread"
+workers = int(os.environ.get("GUNICORN_WORKERS", 1))
+threads = int(os.environ.get("GUNICORN_THREADS", 32))
+
+# With gthread, timeout only limits how long a worker may go without a heartbeat;
+# it does not cap request duration, which Cloud Run's request timeout already
+# does. Disable it so the arbiter never kills a worker busy with long generations.
+timeout = 0